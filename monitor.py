@@ -1,14 +1,30 @@
+import argparse
+import functools
+import json
+import logging
 import os
-import requests
-from tuya_connector import TuyaOpenAPI
+import time
+from dataclasses import dataclass
+from types import SimpleNamespace
 from datetime import datetime
 import pytz
 
+log = logging.getLogger("ice_bath")
+
 # --- CONFIGURATION ---
 ACCESS_ID = os.environ.get("TUYA_ACCESS_ID")
 ACCESS_SECRET = os.environ.get("TUYA_ACCESS_SECRET")
 API_ENDPOINT = "https://openapi.tuyaeu.com" 
 NTFY_TOPIC = "escape_bathhouse_alerts" 
+NTFY_URL = f"https://ntfy.sh/{NTFY_TOPIC}"
+# FIXED: Removed Emoji from 'Title' to prevent UnicodeEncodeError
+# We kept the emoji in the 'Tags' header which is supported by ntfy
+NTFY_HEADERS = {
+    "Title": "Ice Bath Alert", 
+    "Priority": "high",
+    "Tags": "warning,ice_cube"
+}
+SYD_TZ = pytz.timezone('Australia/Sydney')
 
 # LIST OF ICE BATHS
 DEVICES = {
@@ -20,10 +36,52 @@ DEVICES = {
 MIN_FLOW = 19.0  # L/min
 MAX_TEMP = 12.0  # Degrees Celsius
 
-def should_run_check():
+# --- RUN STATE ---
+# Tuya's cloud caches device shadows for ~30s, so checking again sooner just
+# re-reads the same data. Wall-clock time is used because it must survive restarts.
+STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".state.json")
+MIN_CHECK_INTERVAL = 30  # Seconds
+
+# --- MONITORING HOURS (Sydney Time) ---
+# Indexed by weekday(): Monday = 0 ... Sunday = 6
+# Each entry is (start_hour, end_hour) with the end exclusive, or None for no checks
+# Pick one with --schedule (defaults to "closed-mon")
+SCHEDULES = {
+    # This site's current hours
+    "closed-mon": (
+        None,     # Monday: closed
+        (7, 19),  # Tuesday: 7am - 7pm
+        (7, 19),  # Wednesday: 7am - 7pm
+        (7, 19),  # Thursday: 7am - 7pm
+        (7, 20),  # Friday: 7am - 8pm
+        (7, 20),  # Saturday: 7am - 8pm
+        (7, 19),  # Sunday: 7am - 7pm
+    ),
+    # Hours from the other (Sunday-closed) copy of this script, as given in the
+    # request that introduced SCHEDULE - note the later Saturday close
+    "closed-mon-sun": (
+        None,     # Monday: closed
+        (7, 19),  # Tuesday: 7am - 7pm
+        (7, 19),  # Wednesday: 7am - 7pm
+        (7, 19),  # Thursday: 7am - 7pm
+        (7, 20),  # Friday: 7am - 8pm
+        (7, 21),  # Saturday: 7am - 9pm
+        None,     # Sunday: closed
+    ),
+}
+DEFAULT_SCHEDULE = "closed-mon"
+
+# --- HTTP ---
+# Renew the Tuya token on the main thread when it has less than this left. Must be more
+# than the SDK's own 60s refresh window plus the time a round of device checks takes.
+TOKEN_REFRESH_MARGIN = 120  # Seconds
+
+# Built on first use by get_session() so off-hours runs never import requests
+SESSION = None
+
+def should_run_check(schedule_name):
     """Checks if we are within the business monitoring hours (Sydney Time)."""
-    tz = pytz.timezone('Australia/Sydney')
-    now = datetime.now(tz)
+    now = datetime.now(SYD_TZ)
     
     # --- 🎄 HOLIDAY KILL SWITCH 🎄 ---
     # Add any dates here where you want the system to stay silent (Day-Month)
@@ -32,124 +90,284 @@ def should_run_check():
     current_date_str = now.strftime("%d-%m")
     
     if current_date_str in HOLIDAYS:
-        print(f"🎅 Holiday Mode ({current_date_str}): Skipping checks today.")
+        log.info(f"🎅 Holiday Mode ({current_date_str}): Skipping checks today.")
         return False
     # ---------------------------------
 
-    day = now.weekday() 
-    hour = now.hour
+    return _in_window(schedule_name, now.weekday(), now.hour)
 
-    # Monday (0) -> No checks
-    if day == 0: return False
+@functools.lru_cache(maxsize=len(SCHEDULES) * 7 * 24)
+def _in_window(schedule_name, day, hour):
+    """Whether (weekday, hour) falls inside the named schedule - memoised for every hour of the week."""
+    window = SCHEDULES[schedule_name][day]
+    return window is not None and window[0] <= hour < window[1]
 
-    # Tuesday (1) to Thursday (3) AND Sunday (6): 7am - 7pm (19:00)
-    if (1 <= day <= 3) or (day == 6):
-        return 7 <= hour < 19
-    
-    # Friday (4): 7am - 8pm (20:00)
-    if day == 4:
-        return 7 <= hour < 20
+def _load_state():
+    """Reads the last-run state, treating a missing or corrupt file as empty."""
+    try:
+        with open(STATE_FILE, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # Valid JSON that isn't an object (e.g. `[]`) counts as corrupt too
+    return state if isinstance(state, dict) else {}
+
+def _save_state(state):
+    """Writes the state via a temp file + rename so a crash never leaves it half-written."""
+    # A temp file left by an interrupted run is simply overwritten here
+    tmp_path = STATE_FILE + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, STATE_FILE)
+    except OSError as e:
+        # Not worth failing the run over (e.g. read-only or full checkout) - the
+        # check itself has already happened, we just lose the repeat-run guard
+        log.warning(f"⚠️ Could not save run state: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
 
-    # Saturday (5): 7am - 8pm (20:00)
-    if day == 5:
-        return 7 <= hour < 20
+def get_session():
+    """Returns the keep-alive session shared by ntfy and Tuya, building it on first use."""
+    global SESSION
+    if SESSION is None:
+        import orjson
+        import requests
+        import requests.compat
+        import requests.models
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
 
-    return False
+        # The Tuya SDK parses every reply with response.json(); route that through
+        # orjson. This patches requests for the whole process, so only do it when
+        # requests can still catch orjson's decode error: that holds for the stdlib
+        # json.JSONDecodeError, but not when simplejson is installed. Encoding
+        # request bodies stays on requests' own json module.
+        if issubclass(orjson.JSONDecodeError, requests.compat.JSONDecodeError):
+            requests.models.complexjson = SimpleNamespace(
+                loads=orjson.loads,
+                dumps=requests.models.complexjson.dumps,
+            )
+
+        # Transient failures are retried up to 3 times before we give up: urllib3 2.x
+        # retries once straight away, then backs off 1s and 2s (or per Retry-After)
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "POST"],
+            respect_retry_after_header=True,
+        )
+        SESSION = requests.Session()
+        SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return SESSION
+
+def _connect(openapi):
+    """Fetches a fresh Tuya access token, raising ConnectionError if Tuya refuses."""
+    try:
+        response = openapi.connect()
+    except AttributeError as e:
+        # tuya-connector 0.1.2 logs the non-existent `response.body` on any HTTP error
+        # status, so a failed token request surfaces as AttributeError
+        raise ConnectionError(f"HTTP error from Tuya ({e})") from e
+    if not response.get('success'):
+        raise ConnectionError(response.get('msg'))
+
+@functools.lru_cache(maxsize=1)
+def get_openapi():
+    """Connects to Tuya Cloud once per process and reuses the client (and its token)."""
+    # A failed login raises, and lru_cache never caches an exception. Token expiry is
+    # handled by refresh_token_if_due() before each fan-out, not left to the SDK.
+    from tuya_connector import TuyaOpenAPI
+
+    openapi = TuyaOpenAPI(API_ENDPOINT, ACCESS_ID, ACCESS_SECRET)
+    openapi.session = get_session()
+    _connect(openapi)
+    return openapi
+
+def refresh_token_if_due(openapi):
+    """Renews the token on the calling thread if it is close to expiring."""
+    # The SDK refreshes a token within 60s of expiry from inside get(), and blanks
+    # access_token while it does. A second pool worker arriving mid-refresh would sign
+    # with an empty token and get a false error, so renew before fanning out instead.
+    if openapi.token_info.expire_time - TOKEN_REFRESH_MARGIN * 1000 <= time.time() * 1000:
+        _connect(openapi)
 
 def send_alert(message):
     """Sends a push notification via ntfy.sh"""
-    print(f"🚨 SENDING ALERT: {message}")
+    if not message.strip():
+        return
+
+    import requests
+
+    log.info(f"🚨 SENDING ALERT: {message}")
     
-    # FIXED: Removed Emoji from 'Title' to prevent UnicodeEncodeError
-    # We kept the emoji in the 'Tags' header which is supported by ntfy
-    requests.post(f"https://ntfy.sh/{NTFY_TOPIC}", 
-                  data=message.encode(encoding='utf-8'),
-                  headers={
-                      "Title": "Ice Bath Alert", 
-                      "Priority": "high",
-                      "Tags": "warning,ice_cube"
-                  })
+    try:
+        get_session().post(NTFY_URL, data=message.encode("utf-8"), headers=NTFY_HEADERS, timeout=5)
+    except requests.RequestException as e:
+        log.error(f"❌ Failed to send alert: {e}")
+
+@dataclass
+class DeviceState:
+    """Readings parsed from one device's shadow properties."""
+    flow_rate: float = 0.0      # L/min
+    water_temp: float = 0.0     # Degrees Celsius
+    manual_switch: bool = False
+
+def _set_flow(state, val):
+    state.flow_rate = val / 10.0
+
+def _set_temp(state, val):
+    # Reported in tenths of a degree Fahrenheit
+    f_temp = val / 10.0
+    state.water_temp = (f_temp - 32) * 5/9
+
+def _set_switch(state, val):
+    state.manual_switch = bool(val)
+
+def _ignore(state, val):
+    pass
+
+# Property code -> parser. Add new/alternate codes here.
+CODE_HANDLERS = {
+    'flow_water': _set_flow,
+    'temp_current_f': _set_temp,
+    'sw_water': _set_switch,
+}
+
+# Only request the codes we parse - keeps the Tuya response small
+CODES = ",".join(CODE_HANDLERS)
 
 def get_device_status(openapi, device_id, name):
     """Fetches status using the v2.0 Shadow Endpoint (REQUIRED for Flow Rate)."""
-    
+    import requests
+
     # We explicitly ask for flow_water (102), temp_current_f (29), and sw_water (105/125)
-    url = f'/v2.0/cloud/thing/{device_id}/shadow/properties?codes=flow_water,temp_current_f,sw_water'
-    
-    response = openapi.get(url)
+    url = f'/v2.0/cloud/thing/{device_id}/shadow/properties?codes={CODES}'
     
+    try:
+        response = openapi.get(url)
+    except (requests.RequestException, AttributeError) as e:
+        # AttributeError: tuya-connector 0.1.2 reads the non-existent `response.body`
+        # while logging any HTTP error status (e.g. a 401, or a 500 after retries)
+        log.error(f"Error for {name}: {e}")
+        return [("Connection Error ❌", name, None)]
+
     if not response.get('success'):
-        print(f"Error for {name}: {response.get('msg')}")
-        return [f"{name}: Connection Error ❌"]
+        log.error(f"Error for {name}: {response.get('msg')}")
+        return [("Connection Error ❌", name, None)]
 
-    flow_rate = 0.0
-    water_temp = 0.0
-    manual_switch = False
+    state = DeviceState()
     
     # Safe parsing of the v2.0 structure
     properties = response.get('result', {}).get('properties', [])
 
-    print(f"--- Raw Data for {name} ---") 
+    lines = [f"--- Raw Data for {name} ({', '.join(item['code'] for item in properties)}) ---"]
     for item in properties:
-        val = item['value']
-        code = item['code']
-        
-        if code == 'flow_water':
-            flow_rate = val / 10.0
-        elif code == 'temp_current_f':
-            f_temp = val / 10.0
-            water_temp = (f_temp - 32) * 5/9
-        elif code == 'sw_water':
-            manual_switch = bool(val)
+        CODE_HANDLERS.get(item['code'], _ignore)(state, item['value'])
+
+    flow_rate = state.flow_rate
+    water_temp = state.water_temp
 
     # Intelligent Pump Logic: If flow exists, pump is ON (even if switch says off)
     if flow_rate > 1.0:
         pump_display = "ON (Active Flow)"
-    elif manual_switch:
+    elif state.manual_switch:
         pump_display = "ON (Switch)"
     else:
         pump_display = "OFF"
 
-    print(f"   > Summary: Flow={flow_rate}L, Temp={water_temp:.1f}°C, Pump={pump_display}\n")
+    lines.append(f"   > Summary: Flow={flow_rate}L, Temp={water_temp:.1f}°C, Pump={pump_display}")
+    # One record per device so parallel checks don't interleave their output
+    log.info("\n".join(lines))
 
+    # Each issue is (rule, bath name, reading or None)
     issues = []
     
     # RULE 1: LOW FLOW CHECK
     if flow_rate < MIN_FLOW:
         if flow_rate == 0:
-            issues.append(f"{name}: No Flow (Pump Off?)")
+            issues.append(("No Flow (Pump Off?)", name, None))
         else:
-            issues.append(f"{name}: Low Flow ({flow_rate}L)")
+            issues.append(("Low Flow", name, f"{flow_rate}L"))
     
     # RULE 2: HIGH TEMP CHECK
     if water_temp > MAX_TEMP and water_temp > 0:
-        issues.append(f"{name}: High Temp ({water_temp:.1f}°C)")
+        issues.append(("High Temp", name, f"{water_temp:.1f}°C"))
 
     return issues
 
-def main():
-    print("--- Starting Ice Bath Check ---")
+def format_alerts(issues):
+    """Builds the alert message with one line per rule, listing every bath that tripped it."""
+    by_rule = {}
+    for rule, name, reading in issues:
+        by_rule.setdefault(rule, []).append((name, reading))
+
+    lines = []
+    for rule, baths in by_rule.items():
+        if len(baths) == 1:
+            # Single bath keeps the original "Name: Rule (reading)" wording
+            name, reading = baths[0]
+            lines.append(f"{name}: {rule} ({reading})" if reading else f"{name}: {rule}")
+        else:
+            listed = ", ".join(f"{name} ({reading})" if reading else name for name, reading in baths)
+            lines.append(f"{rule}: {listed}")
+    return "\n".join(lines)
+
+def main(schedule=DEFAULT_SCHEDULE):
+    log.info("--- Starting Ice Bath Check ---")
     
-    if not should_run_check():
-        print("💤 Outside monitoring hours. Skipping check.")
+    if not should_run_check(schedule):
+        log.info("💤 Outside monitoring hours. Skipping check.")
         return
 
-    openapi = TuyaOpenAPI(API_ENDPOINT, ACCESS_ID, ACCESS_SECRET)
-    if not openapi.connect():
-        print("❌ Failed to connect to Tuya Cloud")
+    # A last_run in the future (clock stepped back, file copied from another host) is
+    # ignored rather than trusted - otherwise the monitor would go silent until then
+    last_run = _load_state().get("last_run", 0)
+    if isinstance(last_run, bool) or not isinstance(last_run, (int, float)):
+        last_run = 0
+    since_last_run = time.time() - last_run
+    if 0 <= since_last_run < MIN_CHECK_INTERVAL:
+        log.info(f"⏱️ Checked less than {MIN_CHECK_INTERVAL}s ago (Tuya data unchanged). Skipping check.")
+        return
+
+    # Deferred until we know a check is due - most scheduled runs stop above
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    try:
+        openapi = get_openapi()
+        refresh_token_if_due(openapi)
+    except (requests.RequestException, ConnectionError) as e:
+        log.error(f"❌ Failed to connect to Tuya Cloud: {e}")
         return
 
     all_alerts = []
 
-    for name, device_id in DEVICES.items():
-        device_issues = get_device_status(openapi, device_id, name)
-        all_alerts.extend(device_issues)
+    # Query every bath in parallel - each check is just waiting on Tuya's HTTPS reply.
+    # Results come back in DEVICES order so the alert always lists baths the same way.
+    with ThreadPoolExecutor(max_workers=len(DEVICES)) as executor:
+        futures = [
+            executor.submit(get_device_status, openapi, device_id, name)
+            for name, device_id in DEVICES.items()
+        ]
+        for future in futures:
+            all_alerts.extend(future.result())
 
     if all_alerts:
-        full_msg = "\n".join(all_alerts)
-        send_alert(full_msg)
+        send_alert(format_alerts(all_alerts))
     else:
-        print("✅ All Systems Normal")
+        log.info("✅ All Systems Normal")
+
+    _save_state({"last_run": time.time()})
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Check the ice baths and alert via ntfy.sh")
+    parser.add_argument("--schedule", choices=SCHEDULES, default=DEFAULT_SCHEDULE,
+                        help="which weekly monitoring-hours table to use")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format="%(message)s")
+    main(args.schedule)